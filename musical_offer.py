@@ -1,19 +1,33 @@
 import asyncio
+import functools
 import hashlib
+import html
+import json
 import os
 import logging
-from threading import Thread
+import time
 from datetime import datetime, timezone
 
-from flask import Flask
-from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.types import InlineKeyboardButton
+from aiogram.fsm.storage.memory import SimpleEventIsolation
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
-from supabase import create_client
+from postgrest.types import CountMethod, ReturnMethod
+from supabase import acreate_client
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # =======================
 # ЛОГИРОВАНИЕ
@@ -32,19 +46,52 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 MODERATOR_ID = int(os.getenv("MODERATOR_ID"))
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+PORT = int(os.getenv("PORT", 10000))
+TELEGRAM_CONNECTIONS = int(os.getenv("TELEGRAM_CONNECTIONS", 100))
+
+# если задан WEBHOOK_URL — бот работает через вебхук, иначе через long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_PATH = "/webhook"
+
+# без секрета любой может прислать на /webhook поддельный апдейт от имени модератора
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise RuntimeError("WEBHOOK_SECRET обязателен, если задан WEBHOOK_URL")
 
 DEADLINE = datetime(2025, 12, 26, 23, 59, 59, tzinfo=timezone.utc)
 
 # =======================
 # SUPABASE
 # =======================
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# асинхронный клиент: запросы не блокируют event loop.
+# Создаётся в main(), внутри работающего цикла.
+supabase = None
 
 # =======================
 # BOT
 # =======================
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+# aiogram парсит каждый апдейт и сериализует каждый запрос — orjson заметно быстрее stdlib json
+if orjson is not None:
+    json_loads = orjson.loads
+    json_dumps = lambda obj: orjson.dumps(obj).decode()
+else:
+    json_loads, json_dumps = json.loads, json.dumps
+
+# пул keep-alive соединений к Bot API (DNS aiogram кэширует сам)
+session = AiohttpSession(
+    limit=TELEGRAM_CONNECTIONS,
+    json_loads=json_loads,
+    json_dumps=json_dumps
+)
+
+bot = Bot(
+    token=BOT_TOKEN,
+    session=session,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+)
+# апдейты одного пользователя обрабатываются по очереди: иначе два быстрых
+# нажатия или сообщения читают одно и то же состояние FSM до того, как оно обновится
+dp = Dispatcher(events_isolation=SimpleEventIsolation())
 
 # =======================
 # FSM
@@ -55,97 +102,191 @@ class ModerationComment(StatesGroup):
 # =======================
 # UTILS
 # =======================
+@functools.lru_cache(maxsize=4096)
 def hash_user_id(user_id: int) -> str:
-    return hashlib.sha256(str(user_id).encode()).hexdigest()[:16]
+    # те же 16 hex-символов, что hexdigest()[:16], без 64-символьной промежуточной строки
+    return hashlib.sha256(str(user_id).encode()).digest()[:8].hex()
 
 
-def get_all_pending_tracks():
+# первые limit треков очереди (только поля для /check) и общий размер очереди
+async def get_pending_tracks(limit: int):
     try:
-        return supabase.table("pending_tracks") \
+        res = await supabase.table("pending_tracks") \
+            .select("type", "user_hash", count="exact") \
+            .order("created_at", desc=False) \
+            .limit(limit) \
+            .execute()
+        return res.data, res.count or 0
+    except Exception as e:
+        logging.error("get_pending_tracks error: %s", e)
+        return [], 0
+
+
+# модерации нужна только голова очереди — забираем одну строку, а не всю таблицу
+async def get_next_pending_track():
+    try:
+        res = await supabase.table("pending_tracks") \
             .select("*") \
             .order("created_at", desc=False) \
-            .execute().data
+            .limit(1) \
+            .execute()
+        return res.data[0] if res.data else None
     except Exception as e:
-        logging.error(f"get_all_pending_tracks error: {e}")
-        return []
+        logging.error("get_next_pending_track error: %s", e)
+        return None
 
 
-def get_track_by_id(track_id: str):
+async def get_track_by_id(track_id: str):
     try:
-        res = supabase.table("pending_tracks") \
+        res = await supabase.table("pending_tracks") \
             .select("*") \
             .eq("id", track_id) \
             .execute()
         return res.data[0] if res.data else None
     except Exception as e:
-        logging.error(f"get_track_by_id error: {e}")
+        logging.error("get_track_by_id error: %s", e)
         return None
 
+
+def format_track_link(track) -> str:
+    url = html.escape(track["url"], quote=True)
+    title = html.escape(track.get("url_title") or "Ссылка")
+    return f"🔗 <a href='{url}'>{title}</a>"
+
+
+# занятые слоты пользователя: треки на модерации + одобренные
+async def count_user_tracks(user_hash: str) -> int:
+    # запросы независимы — выполняем их одновременно
+    # head=True — PostgREST возвращает только count, без строк
+    pending, approved = await asyncio.gather(
+        supabase.table("pending_tracks")
+            .select("id", count="exact", head=True)
+            .eq("user_hash", user_hash)
+            .execute(),
+        supabase.table("approved_tracks")
+            .select("id", count="exact", head=True)
+            .eq("user_hash", user_hash)
+            .execute()
+    )
+    return (pending.count or 0) + (approved.count or 0)
+
+
+# кэш занятых слотов: user_hash -> (count, время загрузки).
+# Обновляется на отправке/отклонении, раз в SLOT_CACHE_TTL сверяется с БД.
+SLOT_CACHE_TTL = 300
+slot_counts = {}
+
+
+async def get_slot_count(user_hash: str) -> int:
+    cached = slot_counts.get(user_hash)
+    if cached and time.monotonic() - cached[1] < SLOT_CACHE_TTL:
+        return cached[0]
+
+    count = await count_user_tracks(user_hash)
+    slot_counts[user_hash] = (count, time.monotonic())
+    return count
+
+
+def change_slot_count(user_hash: str, delta: int):
+    cached = slot_counts.get(user_hash)
+    if cached:
+        slot_counts[user_hash] = (cached[0] + delta, cached[1])
+
+
+# ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+background_tasks = set()
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+# не больше NOTIFY_RATE уведомлений в секунду (лимит Telegram — 30 сообщений/с на бота):
+# каждое уведомление держит слот семафора ещё секунду после отправки
+NOTIFY_RATE = 25
+notify_slots = asyncio.Semaphore(NOTIFY_RATE)
+
+
+async def notify_user(user_id: int, text: str):
+    async with notify_slots:
+        try:
+            await bot.send_message(user_id, text)
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            try:
+                await bot.send_message(user_id, text)
+            except Exception as e:
+                logging.warning("notify_user %s retry error: %s", user_id, e)
+        except Exception as e:
+            logging.warning("notify_user %s error: %s", user_id, e)
+
+        await asyncio.sleep(1)
+
 # =======================
 # /start
 # =======================
+RULES_URL = "https://teletype.in/@artem2601/8pDqOmM9g4X"
+
+# клавиатура одинакова для всех — собираем один раз
+START_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[[
+    InlineKeyboardButton(
+        text="📜 Правила тусовки",
+        url=RULES_URL
+    )
+]])
+
+# статичная часть приветствия собирается один раз, в хендлере подставляются только данные
+START_TEXT = (
+    "🎧 <b>Party Music Bot</b>\n\n"
+    "Привет, <b>{name}</b>! 👋\n\n"
+    "Ты участвуешь в создании общего плейлиста для тусовки 🎉\n\n"
+
+    "📜 <b>Правила:</b>\n"
+    "• можно отправить <b>до 3 треков</b>\n"
+    "• принимаются 🎵 аудиофайлы и 🔗 ссылки\n"
+    "• треки должны соответствовать атмосфере мероприятия\n"
+    "• полный список правил — по ссылке ниже\n\n"
+
+    "🧑‍⚖️ <b>Модерация:</b>\n"
+    "• каждый трек проверяется вручную\n"
+    "• <b>одобренный</b> — попадает в плейлист\n"
+    "• <b>отклонённый</b> — можно заменить новым\n"
+    "• модератор не видит твой профиль\n\n"
+
+    "📊 <b>Твой прогресс:</b>\n"
+    "• отправлено: {sent}/3\n"
+    "• осталось: {remaining}\n\n"
+
+    "🔐 Анонимность гарантирована\n"
+    "⏰ Дедлайн: <b>22 декабря</b>"
+)
+
+
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     user_id = message.from_user.id
     user_hash = hash_user_id(user_id)
 
     try:
-        pending = supabase.table("pending_tracks") \
-            .select("id") \
-            .eq("user_hash", user_hash) \
-            .execute().data
-
-        approved = supabase.table("approved_tracks") \
-            .select("id") \
-            .eq("user_hash", user_hash) \
-            .execute().data
+        sent = await get_slot_count(user_hash)
     except Exception as e:
-        logging.error(f"/start load error: {e}")
+        logging.error("/start load error: %s", e)
         await message.answer("❌ Не удалось загрузить данные. Попробуй позже.")
         return
 
-    sent = len(pending) + len(approved)
     remaining = max(0, 3 - sent)
 
-    rules_url = "https://teletype.in/@artem2601/8pDqOmM9g4X"
-
-    text = (
-        f"🎧 <b>Party Music Bot</b>\n\n"
-        f"Привет, <b>{message.from_user.first_name}</b>! 👋\n\n"
-        f"Ты участвуешь в создании общего плейлиста для тусовки 🎉\n\n"
-
-        f"📜 <b>Правила:</b>\n"
-        f"• можно отправить <b>до 3 треков</b>\n"
-        f"• принимаются 🎵 аудиофайлы и 🔗 ссылки\n"
-        f"• треки должны соответствовать атмосфере мероприятия\n"
-        f"• полный список правил — по ссылке ниже\n\n"
-
-        f"🧑‍⚖️ <b>Модерация:</b>\n"
-        f"• каждый трек проверяется вручную\n"
-        f"• <b>одобренный</b> — попадает в плейлист\n"
-        f"• <b>отклонённый</b> — можно заменить новым\n"
-        f"• модератор не видит твой профиль\n\n"
-
-        f"📊 <b>Твой прогресс:</b>\n"
-        f"• отправлено: {sent}/3\n"
-        f"• осталось: {remaining}\n\n"
-
-        f"🔐 Анонимность гарантирована\n"
-        f"⏰ Дедлайн: <b>22 декабря</b>"
-    )
-
-    keyboard = InlineKeyboardBuilder()
-    keyboard.add(
-        InlineKeyboardButton(
-            text="📜 Правила тусовки",
-            url=rules_url
-        )
+    text = START_TEXT.format(
+        name=html.escape(message.from_user.first_name),
+        sent=sent,
+        remaining=remaining
     )
 
     await message.answer(
         text,
-        reply_markup=keyboard.as_markup(),
-        parse_mode="HTML",
+        reply_markup=START_KEYBOARD,
         disable_web_page_preview=True
     )
 
@@ -153,12 +294,15 @@ async def cmd_start(message: types.Message):
 # =======================
 # MODERATOR COMMANDS
 # =======================
+CHECK_LIMIT = 50
+
+
 @dp.message(Command("check"))
 async def cmd_check(message: types.Message):
     if message.from_user.id != MODERATOR_ID:
         return
 
-    pending = get_all_pending_tracks()
+    pending, total = await get_pending_tracks(CHECK_LIMIT)
     if not pending:
         await message.answer("📭 Нет треков")
         return
@@ -166,6 +310,8 @@ async def cmd_check(message: types.Message):
     text = ["📋 Треки на модерации:"]
     for i, t in enumerate(pending, 1):
         text.append(f"{i}. {t['type']} ({t['user_hash'][:8]}...)")
+    if total > len(pending):
+        text.append(f"… и ещё {total - len(pending)}")
 
     await message.answer("\n".join(text))
 
@@ -175,12 +321,39 @@ async def cmd_moderate(message: types.Message):
     if message.from_user.id != MODERATOR_ID:
         return
 
-    pending = get_all_pending_tracks()
-    if not pending:
+    track = await get_next_pending_track()
+    if not track:
         await message.answer("📭 Очередь пуста")
         return
 
-    await send_moderation_message(pending[0], pending[0]["id"])
+    await send_moderation_message(track, track["id"])
+
+
+# сколько раз повторять отправку аудио после флуд-контроля
+TRACK_SEND_RETRIES = 3
+# для /tracks нужны только эти поля — не тянем user_hash, user_id и прочее
+TRACK_LIST_COLUMNS = ("type", "file_id", "url", "url_title")
+# PostgREST режет ответ по max-rows, поэтому читаем страницами.
+# Конец — пустая страница: короткая может означать и max-rows меньше TRACKS_PAGE_SIZE
+TRACKS_PAGE_SIZE = 100
+# с запасом до лимита Telegram в 4096 символов
+MESSAGE_CHUNK_LIMIT = 3500
+
+
+async def get_tracks(table: str):
+    tracks = []
+    start = 0
+    while True:
+        res = await supabase.table(table) \
+            .select(*TRACK_LIST_COLUMNS) \
+            .order("created_at") \
+            .order("id") \
+            .range(start, start + TRACKS_PAGE_SIZE - 1) \
+            .execute()
+        if not res.data:
+            return tracks
+        tracks.extend(res.data)
+        start += len(res.data)
 
 
 @dp.message(Command("tracks"))
@@ -189,46 +362,63 @@ async def cmd_tracks(message: types.Message):
         await message.answer("❌ Нет прав.")
         return
 
-    approved = supabase.table("approved_tracks").select("*").order("created_at").execute().data
-    rejected = supabase.table("rejected_tracks").select("*").order("created_at").execute().data
+    approved, rejected = await asyncio.gather(
+        get_tracks("approved_tracks"),
+        get_tracks("rejected_tracks")
+    )
 
-    # 🎧 Одобренные
-    await message.answer("🎧 <b>Одобренные треки:</b>", parse_mode="HTML")
+    await send_track_list(message, "🎧 <b>Одобренные треки:</b>", approved, "🎵 Одобренный трек")
+    await send_track_list(message, "\n❌ <b>Отклонённые треки:</b>", rejected, "🎵 Отклонённый трек")
 
-    if not approved:
-        await message.answer("— нет")
-    else:
-        for t in approved:
-            if t["type"] == "audio" and t.get("file_id"):
-                await message.answer_audio(
-                    audio=t["file_id"],
-                    caption="🎵 Одобренный трек"
-                )
-            elif t["type"] == "url":
-                title = t.get("url_title", "Ссылка")
-                await message.answer(
-                    f"🔗 <a href='{t['url']}'>{title}</a>",
-                    parse_mode="HTML"
-                )
-
-    # ❌ Отклонённые
-    await message.answer("\n❌ <b>Отклонённые треки:</b>", parse_mode="HTML")
-
-    if not rejected:
+
+async def send_track_audio(message: types.Message, file_id: str, caption: str):
+    for attempt in range(TRACK_SEND_RETRIES + 1):
+        try:
+            await message.answer_audio(audio=file_id, caption=caption)
+            return
+        except TelegramRetryAfter as e:
+            if attempt == TRACK_SEND_RETRIES:
+                logging.warning("send_track_audio %s: flood control, giving up", file_id)
+                return
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            # битый file_id и т.п. — пропускаем трек, остальной список отправляем
+            logging.warning("send_track_audio %s error: %s", file_id, e)
+            return
+
+
+async def send_track_list(message: types.Message, header: str, tracks, audio_caption: str):
+    await message.answer(header)
+
+    if not tracks:
         await message.answer("— нет")
-    else:
-        for t in rejected:
-            if t["type"] == "audio" and t.get("file_id"):
-                await message.answer_audio(
-                    audio=t["file_id"],
-                    caption="🎵 Отклонённый трек"
-                )
-            elif t["type"] == "url":
-                title = t.get("url_title", "Ссылка")
-                await message.answer(
-                    f"🔗 <a href='{t['url']}'>{title}</a>",
-                    parse_mode="HTML"
-                )
+        return
+
+    # аудио — отдельными сообщениями по порядку created_at. В один чат Telegram
+    # пропускает около сообщения в секунду, так что параллельная отправка
+    # только упирается во флуд-контроль
+    for t in tracks:
+        if t["type"] == "audio" and t.get("file_id"):
+            await send_track_audio(message, t["file_id"], audio_caption)
+
+    # ссылки — пачками в несколько сообщений, каждое в пределах MESSAGE_CHUNK_LIMIT
+    chunk = []
+    chunk_len = 0
+    for t in tracks:
+        if t["type"] != "url":
+            continue
+
+        line = format_track_link(t)
+        if chunk and chunk_len + len(line) + 1 > MESSAGE_CHUNK_LIMIT:
+            await message.answer("\n".join(chunk))
+            chunk = []
+            chunk_len = 0
+
+        chunk.append(line)
+        chunk_len += len(line) + 1
+
+    if chunk:
+        await message.answer("\n".join(chunk))
 
 
 # =======================
@@ -240,30 +430,61 @@ async def handle_moderation(callback: types.CallbackQuery, state: FSMContext):
         return
 
     action, track_id = callback.data.split("_", 1)
-    track = get_track_by_id(track_id)
+
+    # повторное нажатие по той же карточке: решение уже выбрано, ждём комментарий
+    if await state.get_state() == ModerationComment.waiting_for_comment.state \
+            and (await state.get_data()).get("track_id") == track_id:
+        await callback.answer("📝 Жду комментарий")
+        return
+
+    track = await get_track_by_id(track_id)
 
     if not track:
         await callback.answer("Трек не найден", show_alert=True)
         return
 
     await state.set_state(ModerationComment.waiting_for_comment)
-    await state.update_data(action=action, track_id=track_id)
+    # строку трека храним в состоянии, чтобы process_comment не читал её повторно
+    await state.update_data(action=action, track_id=track_id, track=track)
+
+    # превращаем карточку трека в запрос комментария одним вызовом вместо answer + delete
+    prompt = "\n\n📝 Введи комментарий:"
 
-    await callback.message.answer("📝 Введи комментарий:")
-    await callback.message.delete()
+    # слишком старая карточка приходит как InaccessibleMessage — её не отредактировать
+    if not isinstance(callback.message, types.Message):
+        await callback.message.answer(prompt.strip())
+        return
+
+    try:
+        if callback.message.audio:
+            await callback.message.edit_caption(
+                caption=html.escape(callback.message.caption or "") + prompt,
+                reply_markup=None
+            )
+        else:
+            await callback.message.edit_text(
+                html.escape(callback.message.text or "") + prompt,
+                reply_markup=None
+            )
+    except TelegramBadRequest as e:
+        # карточка уже превращена в запрос комментария — ничего делать не нужно
+        if "message is not modified" in e.message:
+            await callback.answer()
+            return
+        # запроса на экране нет — не оставляем модератора в ожидании комментария
+        await state.clear()
+        raise
 
 
 @dp.message(ModerationComment.waiting_for_comment)
 async def process_comment(message: types.Message, state: FSMContext):
+    # забираем решение и сразу сбрасываем состояние — до любых запросов в БД,
+    # чтобы второе сообщение модератора не сохранило то же решение ещё раз
     data = await state.get_data()
+    await state.clear()
     action = data["action"]
     track_id = data["track_id"]
-
-    track = get_track_by_id(track_id)
-    if not track:
-        await message.answer("❌ Трек уже обработан")
-        await state.clear()
-        return
+    track = data["track"]
 
     safe_track = {
         "type": track["type"],
@@ -274,82 +495,93 @@ async def process_comment(message: types.Message, state: FSMContext):
     }
 
     try:
+        # строка обратно не нужна: return=minimal, ошибка вставки придёт исключением
         if action == "approve":
-            res = supabase.table("approved_tracks").insert(safe_track).execute()
+            await supabase.table("approved_tracks") \
+                .insert(safe_track, returning=ReturnMethod.minimal) \
+                .execute()
         else:
-            res = supabase.table("rejected_tracks").insert(safe_track).execute()
-
-        if not res.data:
-            raise Exception("Insert failed")
-
-        supabase.table("pending_tracks").delete().eq("id", track_id).execute()
-
-        await message.answer("✅ Решение сохранено")
-
-        if track.get("user_id"):
-            await bot.send_message(
-                track["user_id"],
-                "🎶 Твой трек обработан!",
-                parse_mode="HTML"
-            )
+            await supabase.table("rejected_tracks") \
+                .insert(safe_track, returning=ReturnMethod.minimal) \
+                .execute()
+
+        # из очереди убираем только после того, как решение сохранено;
+        # count показывает, был ли трек ещё в очереди
+        deleted = await supabase.table("pending_tracks") \
+            .delete(count=CountMethod.exact, returning=ReturnMethod.minimal) \
+            .eq("id", track_id) \
+            .execute()
 
     except Exception as e:
-        logging.error(f"MODERATION ERROR: {e}")
-        logging.error(f"TRACK DATA: {safe_track}")
+        logging.error("MODERATION ERROR: %s", e)
+        logging.error("TRACK DATA: %s", safe_track)
         await message.answer("❌ Ошибка сохранения решения")
 
-    await state.clear()
+    else:
+        if not deleted.count:
+            # трек обработали раньше — только что сохранённое решение лишнее
+            logging.error("DUPLICATE DECISION: track %s (%s) %s", track_id, action, safe_track)
+            await message.answer("❌ Трек уже обработан — проверь дубль в таблице решений")
+        else:
+            # одобренный трек так и занимает слот, отклонённый — освобождает
+            if action == "reject":
+                change_slot_count(track["user_hash"], -1)
+
+            await message.answer("✅ Решение сохранено")
 
-    pending = get_all_pending_tracks()
-    if pending:
-        await send_moderation_message(pending[0], pending[0]["id"])
+            if track.get("user_id"):
+                run_in_background(notify_user(track["user_id"], "🎶 Твой трек обработан!"))
+
+    next_track = await get_next_pending_track()
+    if next_track:
+        await send_moderation_message(next_track, next_track["id"])
     else:
         await message.answer("🎉 Очередь пуста")
 
 # =======================
 # SEND TO MODERATOR
 # =======================
-async def send_moderation_message(track, track_id):
-    kb = InlineKeyboardBuilder()
-    kb.row(
+def moderation_keyboard(track_id) -> InlineKeyboardMarkup:
+    # меняется только callback_data — собираем разметку напрямую, без билдера
+    return InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton(text="✅ Одобрить", callback_data=f"approve_{track_id}"),
         InlineKeyboardButton(text="❌ Отклонить", callback_data=f"reject_{track_id}")
-    )
+    ]])
+
+
+async def send_moderation_message(track, track_id):
+    kb = moderation_keyboard(track_id)
 
     if track["type"] == "audio":
         await bot.send_audio(
             MODERATOR_ID,
             track["file_id"],
             caption="🎵 Трек на модерации",
-            reply_markup=kb.as_markup()
+            reply_markup=kb
         )
     else:
         await bot.send_message(
             MODERATOR_ID,
-            track["url"],
-            reply_markup=kb.as_markup()
+            html.escape(track["url"]),
+            reply_markup=kb
         )
 
 # =======================
 # USER HANDLER
 # =======================
-@dp.message()
+# команды (в т.ч. неизвестные) отсекаются фильтром ещё на диспетчере;
+# сообщения без текста проходят, чтобы получить подсказку ниже
+@dp.message(~F.text.startswith("/"))
 async def handle_user_message(message: types.Message):
-    if message.text and message.text.startswith("/"):
-        return
-
-    now = datetime.fromisoformat(message.date.isoformat()).replace(tzinfo=timezone.utc)
-    if now > DEADLINE:
+    # проверяем дедлайн до любых запросов в БД
+    if message.date.replace(tzinfo=timezone.utc) > DEADLINE:
         await message.answer("⏰ Приём завершён")
         return
 
     user_id = message.from_user.id
     user_hash = hash_user_id(user_id)
 
-    pending = supabase.table("pending_tracks").select("id").eq("user_hash", user_hash).execute().data
-    approved = supabase.table("approved_tracks").select("id").eq("user_hash", user_hash).execute().data
-
-    if len(pending) + len(approved) >= 3:
+    if await get_slot_count(user_hash) >= 3:
         await message.answer("❌ Лимит исчерпан")
         return
 
@@ -366,24 +598,72 @@ async def handle_user_message(message: types.Message):
     track_data["user_id"] = user_id
     track_data["user_hash"] = user_hash
 
-    supabase.table("pending_tracks").insert(track_data).execute()
+    # слот занимаем до первого await: get_slot_count только что положил запись в кэш,
+    # и параллельное сообщение того же пользователя уже увидит её занятой
+    change_slot_count(user_hash, +1)
+    try:
+        await supabase.table("pending_tracks") \
+            .insert(track_data, returning=ReturnMethod.minimal) \
+            .execute()
+    except Exception:
+        change_slot_count(user_hash, -1)
+        raise
+
     await message.answer("✅ Трек отправлен на модерацию")
 
 # =======================
-# FLASK (RENDER)
+# WEB: HEALTHCHECK (RENDER) + WEBHOOK
 # =======================
-app = Flask(__name__)
+app = web.Application()
+
+
+async def home(request: web.Request):
+    return web.json_response({"status": "ok"})
+
+app.router.add_get("/", home)
+
 
-@app.route("/")
-def home():
-    return {"status": "ok"}
+async def main():
+    global supabase
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
 
-def run_flask():
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 10000)))
+    if WEBHOOK_URL:
+        # апдейты обрабатываются фоновыми задачами, Telegram получает ответ сразу
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            handle_in_background=True,
+            secret_token=WEBHOOK_SECRET
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+
+    # healthcheck живёт в том же event loop, что и бот — без отдельного потока
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET
+            )
+            await asyncio.Event().wait()
+        else:
+            # вебхук, оставшийся с прошлого запуска, ломает getUpdates (409 Conflict)
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await runner.cleanup()
 
 # =======================
 # START
 # =======================
 if __name__ == "__main__":
-    Thread(target=run_flask, daemon=True).start()
-    asyncio.run(dp.start_polling(bot))
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
+    asyncio.run(main())